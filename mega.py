@@ -1,11 +1,21 @@
+import io
 import os
 import re
 import shutil
+import tarfile
 import zipfile
 import time
+import functools
+import statistics
+import threading
 import asyncio
 import logging
 from pyrogram import Client, filters
+from pyrogram.errors import FloodWait
+import mega.mega as mega_api
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from mega import Mega
 from dotenv import load_dotenv
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -22,6 +32,67 @@ bot_token = os.getenv("BOT_TOKEN")
 api_id = int(os.getenv("API_ID"))
 api_hash = os.getenv("API_HASH")
 
+MEGA_LINK_REGEX = re.compile(r"https://mega\.nz/(file|folder)/[A-Za-z0-9_-]+(?:#[A-Za-z0-9_-]+)?")
+
+# Files above this size are uploaded in parts
+SPLIT_THRESHOLD = 2000 * 1024 * 1024  # Telegram's 2000 MiB upload limit
+# Extensions always checked for a ZIP archive, whatever their first bytes
+ZIP_EXTENSIONS = ('.zip', '.cbz', '.jar', '.apk')
+# ZIP archives with more members than this, mostly small ones, are re-packed into tarballs
+BUNDLE_MIN_FILES = 50
+BUNDLE_MAX_MEDIAN_SIZE = 10 * 1024 * 1024  # 10 MB
+BUNDLE_SIZE_LIMIT = 1900 * 1024 * 1024  # leaves room for the tar end-of-archive padding
+
+# Progress messages are edited at most when the percentage moves this much, or this often
+PROGRESS_MIN_STEP = 2  # percent
+PROGRESS_MIN_INTERVAL = 3  # seconds
+
+# Number of concurrent uploads while extracting ZIP archives
+UPLOAD_WORKERS = 4
+# Number of concurrent part uploads for files above SPLIT_THRESHOLD
+UPLOAD_PARALLELISM = int(os.getenv("MEGA_UPLOAD_PARALLELISM", "4"))
+
+# Maximum number of links processed at the same time
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MEGA_MAX_CONCURRENCY", "3"))
+download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+# Strong references to running download tasks
+background_tasks = set()
+
+class CountingReader:
+    """Wraps a raw response stream, adding every byte read to `progress`."""
+
+    def __init__(self, raw, progress):
+        self._raw = raw
+        self._progress = progress
+
+    def read(self, *args, **kwargs):
+        data = self._raw.read(*args, **kwargs)
+        self._progress["downloaded"] += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+class MegaSession(requests.Session):
+    """Session that counts the bytes of streamed downloads made by a tracked thread."""
+
+    def __init__(self):
+        super().__init__()
+        self.downloads = {}
+
+    def get(self, url, **kwargs):
+        response = super().get(url, **kwargs)
+        progress = self.downloads.get(threading.get_ident())
+        if progress is not None and kwargs.get("stream"):
+            progress["total"] = int(response.headers.get("Content-Length", 0))
+            response.raw = CountingReader(response.raw, progress)
+        return response
+
+# Share one pooled HTTP session across all Mega API calls and downloads
+http_session = MegaSession()
+http_session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.3)))
+mega_api.requests = http_session
+
 app = Client("mega_download_bot", bot_token=bot_token, api_id=api_id, api_hash=api_hash)
 mega = Mega()
 
@@ -55,7 +126,8 @@ async def help_callback(client, callback_query):
         "1. Send a valid Mega.nz link (file or folder).\n"
         "2. The bot will download and send the file to you.\n"
         "3. Files larger than 2 GB will be split into chunks for upload.\n"
-        "4. For ZIP files, they will be extracted and sent as individual files.\n\n"
+        "4. ZIP files up to 2 GB will be extracted and sent as individual files; larger ZIP files are split and sent as-is.\n"
+        "5. ZIP files with more than 50 mostly small files are repacked and sent as .tar bundles instead.\n\n"
         "If you need assistance, contact support."
     )
     keyboard = InlineKeyboardMarkup([
@@ -102,111 +174,324 @@ async def back_callback(client, callback_query):
     await callback_query.answer()
     await callback_query.message.edit_text(start_text, reply_markup=keyboard)
 
-async def split_and_upload(file_path, chat_id, client, progress_message):
-    """Splits large files and uploads each part."""
-    chunk_size = 2 * 1024 * 1024 * 1024  # 2 GB
-    file_size = os.path.getsize(file_path)
+class FileSlice(io.RawIOBase):
+    """Read-only view over a byte range of an open file."""
+
+    def __init__(self, fp, start, length, name=None):
+        self._fp = fp
+        self._start = start
+        self._length = length
+        self._pos = 0
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._length + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        self._pos = max(0, min(pos, self._length))
+        return self._pos
+
+    def readinto(self, b):
+        size = min(len(b), self._length - self._pos)
+        if size <= 0:
+            return 0
+        data = os.pread(self._fp.fileno(), size, self._start + self._pos)
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+async def split_and_upload(file_path, chat_id, client, progress_message, file_size=None):
+    """Uploads a large file in parts read directly from the source file."""
+    chunk_size = SPLIT_THRESHOLD
+    if file_size is None:
+        file_size = os.path.getsize(file_path)
     base_name = os.path.basename(file_path)
+    total_parts = -(-file_size // chunk_size)
 
     await progress_message.edit_text("The file is larger than 2 GB and will be split into chunks for upload. Please wait...")
 
-    with open(file_path, 'rb') as f:
-        chunk_index = 0
-        while True:
-            chunk = f.read(chunk_size)
-            if not chunk:
-                break
-
-            chunk_path = f"{file_path}.part{chunk_index}"
-            with open(chunk_path, 'wb') as chunk_file:
-                chunk_file.write(chunk)
+    semaphore = asyncio.Semaphore(UPLOAD_PARALLELISM)
 
+    async def upload_part(f, chunk_index, offset, length):
+        part_name = f"{base_name}.part{chunk_index}"
+        async with semaphore:
             await client.send_document(
                 chat_id=chat_id,
-                document=chunk_path,
-                caption=f"Part {chunk_index + 1}/{(file_size // chunk_size) + 1} of {base_name}"
+                document=FileSlice(f, offset, length, name=part_name),
+                file_name=part_name,
+                caption=f"Part {chunk_index + 1}/{total_parts} of {base_name}"
             )
-            os.remove(chunk_path)
-            chunk_index += 1
-
-async def update_progress(file_path, message, task_type):
-    """Updates the progress of a task."""
-    file_size = os.path.getsize(file_path)
-    while os.path.exists(file_path):
-        current_size = os.path.getsize(file_path)
-        progress_percentage = (current_size / file_size) * 100 if file_size > 0 else 0
-        progress_text = f"{task_type} Progress: {progress_percentage:.2f}% ({current_size // (1024 * 1024)}MB/{file_size // (1024 * 1024)}MB)"
+
+    with open(file_path, 'rb') as f:
+        tasks = [
+            asyncio.create_task(upload_part(f, chunk_index, offset, min(chunk_size, file_size - offset)))
+            for chunk_index, offset in enumerate(range(0, file_size, chunk_size))
+        ]
         try:
-            await message.edit_text(progress_text)
-        except Exception:
-            logger.warning("Failed to update progress message.")
-            pass
-        if current_size >= file_size:
-            break
-        await asyncio.sleep(1)
-
-@app.on_message(filters.text & filters.regex(r"https://mega\.nz/(file|folder)/[A-Za-z0-9_-]+(?:#[A-Za-z0-9_-]+)?"))
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop the remaining parts before the file is closed under them
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+def member_path(root, name):
+    """Resolves a ZIP member name under `root`, or returns None if it would escape it."""
+    root = os.path.abspath(root)
+    target = os.path.abspath(os.path.join(root, name))
+    if os.path.commonpath([root, target]) != root:
+        logger.warning(f"Skipping unsafe ZIP entry: {name}")
+        return None
+    return target
+
+def extract_zip(file_path, extracted_path, on_extracted=None):
+    """Streams every member of a ZIP archive to disk."""
+    with zipfile.ZipFile(file_path, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir():
+                continue
+            target = member_path(extracted_path, info.filename)
+            if target is None:
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with zip_ref.open(info) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            if on_extracted:
+                on_extracted(target)
+
+def looks_like_zip(file_path):
+    """Cheaply checks the extension and magic bytes before the full ZIP check."""
+    if str(file_path).lower().endswith(ZIP_EXTENSIONS):
+        return True
+    with open(file_path, 'rb') as f:
+        return f.read(4) == b'PK\x03\x04'
+
+def is_zip(file_path):
+    """Checks whether a downloaded file is a ZIP archive."""
+    return looks_like_zip(file_path) and zipfile.is_zipfile(file_path)
+
+def should_bundle(file_path):
+    """Checks whether a ZIP archive holds many small files better sent together."""
+    with zipfile.ZipFile(file_path, 'r') as zip_ref:
+        sizes = [info.file_size for info in zip_ref.infolist() if not info.is_dir()]
+    return len(sizes) > BUNDLE_MIN_FILES and statistics.median(sizes) < BUNDLE_MAX_MEDIAN_SIZE
+
+def bundle_zip(file_path, bundle_path, on_bundled=None):
+    """Repacks the members of a ZIP archive into uncompressed tarballs."""
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    tar = None
+    tar_path = None
+    bundle_index = 0
+    bundle_size = 0
+
+    def finish_bundle():
+        tar.close()
+        if on_bundled:
+            on_bundled(tar_path)
+
+    with zipfile.ZipFile(file_path, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir() or member_path(bundle_path, info.filename) is None:
+                continue
+            # Each tar member takes a 512-byte header plus its data padded to 512 bytes
+            member_size = tarfile.BLOCKSIZE + -(-info.file_size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            if tar is None or (bundle_size and bundle_size + member_size > BUNDLE_SIZE_LIMIT):
+                if tar is not None:
+                    finish_bundle()
+                bundle_index += 1
+                tar_path = os.path.join(bundle_path, f"{base_name}.{bundle_index}.tar")
+                tar = tarfile.open(tar_path, 'w', copybufsize=1024 * 1024)
+                bundle_size = 0
+            tar_info = tarfile.TarInfo(info.filename)
+            tar_info.size = info.file_size
+            tar_info.mtime = time.mktime(info.date_time + (0, 0, -1))
+            with zip_ref.open(info) as src:
+                tar.addfile(tar_info, src)
+            bundle_size += member_size
+    if tar is not None:
+        finish_bundle()
+
+def remove_file(file_path):
+    """Removes a file, ignoring it if it is already gone."""
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+async def upload_while_producing(produce, chat_id, client, progress_message, caption):
+    """Runs `produce` in a thread, uploading each file it reports as soon as it is ready."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=8)
+    failed = []
+
+    def enqueue(file_to_send):
+        # Called from the producer thread; blocks while the queue is full.
+        asyncio.run_coroutine_threadsafe(queue.put(file_to_send), loop).result()
+
+    async def uploader():
+        while True:
+            file_to_send = await queue.get()
+            try:
+                if file_to_send is None:
+                    return
+                if await asyncio.to_thread(os.path.getsize, file_to_send) > SPLIT_THRESHOLD:
+                    await split_and_upload(file_to_send, chat_id, client, progress_message)
+                else:
+                    await client.send_document(
+                        chat_id=chat_id,
+                        document=file_to_send,
+                        caption=f"{caption}: {os.path.basename(file_to_send)}"
+                    )
+            except Exception as e:
+                # Keep draining the queue so the producer never blocks; failures are reported below
+                logger.error(f"Failed to upload {file_to_send}: {e}")
+                failed.append(os.path.basename(file_to_send))
+            finally:
+                if file_to_send is not None:
+                    await asyncio.to_thread(remove_file, file_to_send)
+                queue.task_done()
+
+    workers = [asyncio.create_task(uploader()) for _ in range(UPLOAD_WORKERS)]
+    try:
+        await asyncio.to_thread(produce, enqueue)
+    finally:
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+    if failed:
+        raise RuntimeError(f"Failed to upload {len(failed)} file(s): {', '.join(failed)}")
+
+def download_with_progress(mega_link, dest_path, progress):
+    """Downloads a Mega.nz link, recording its byte count in `progress`."""
+    thread_id = threading.get_ident()
+    http_session.downloads[thread_id] = progress
+    try:
+        return mega_client.download_url(mega_link, dest_path=dest_path)
+    finally:
+        del http_session.downloads[thread_id]
+
+async def update_progress(task, progress, message, task_type):
+    """Updates the progress of a task until it finishes."""
+    last_percentage = None
+    last_edit = 0
+    while not task.done():
+        current_size = progress["downloaded"]
+        file_size = progress["total"]
+        if file_size > 0:
+            progress_percentage = (current_size / file_size) * 100
+            now = time.monotonic()
+            # Telegram throttles message edits, so only edit on a visible change
+            if last_percentage is None or (progress_percentage != last_percentage and (
+                    progress_percentage - last_percentage >= PROGRESS_MIN_STEP
+                    or now - last_edit >= PROGRESS_MIN_INTERVAL)):
+                progress_text = f"{task_type} Progress: {progress_percentage:.2f}% ({current_size // (1024 * 1024)}MB/{file_size // (1024 * 1024)}MB)"
+                try:
+                    await message.edit_text(progress_text)
+                    last_percentage = progress_percentage
+                    last_edit = now
+                except FloodWait as e:
+                    logger.warning(f"Progress updates rate limited for {e.value} seconds.")
+                    await asyncio.wait({task}, timeout=e.value)
+                    continue
+                except Exception:
+                    logger.warning("Failed to update progress message.")
+        await asyncio.wait({task}, timeout=2)
+
+@app.on_message(filters.text & filters.regex(MEGA_LINK_REGEX))
 async def download_file(client, message):
     """Handles file download and processing from Mega.nz links."""
-    mega_link_match = re.search(r"https://mega\.nz/(file|folder)/[A-Za-z0-9_-]+(?:#[A-Za-z0-9_-]+)?", message.text)
-    if not mega_link_match:
-        await message.reply("❌ No valid Mega.nz link found.")
-        return
-
-    mega_link = mega_link_match.group(0)
+    # The regex filter has already matched the link and stored it on the message
+    mega_link = message.matches[0].group(0)
     if "folder" in mega_link:
         await message.reply("❌ Folder downloads are not supported at the moment. Please provide a file link.")
         return
 
-    dest_path = "downloads/"
-    os.makedirs(dest_path, exist_ok=True)
+    task = asyncio.create_task(process_download(client, message, mega_link))
+    background_tasks.add(task)
+    task.add_done_callback(finish_background_task)
 
-    progress_message = await message.reply("Starting download...")
+def finish_background_task(task):
+    """Drops a finished download task and logs any exception it escaped with."""
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Download task failed: {task.exception()}")
 
+async def process_download(client, message, mega_link):
+    """Downloads a Mega.nz link and uploads the result to the chat."""
     try:
-        start_time = time.time()
-        file_path = mega_client.download_url(mega_link, dest_path=dest_path)
-        elapsed_time = time.time() - start_time
+        progress_message = await message.reply("Starting download...")
+    except Exception as e:
+        logger.error(f"Failed to send the progress message: {e}")
+        return
 
-        await update_progress(file_path, progress_message, "Download")
+    # Keep each request in its own directory so concurrent downloads never collide
+    dest_path = os.path.join("downloads", f"{message.chat.id}_{message.id}")
 
-        if zipfile.is_zipfile(file_path):
-            extracted_path = os.path.join(dest_path, "extracted")
-            os.makedirs(extracted_path, exist_ok=True)
+    async with download_semaphore:
+        try:
+            os.makedirs(dest_path, exist_ok=True)
+            start_time = time.time()
+            progress = {"downloaded": 0, "total": 0}
+            download = asyncio.create_task(asyncio.to_thread(download_with_progress, mega_link, dest_path, progress))
+            await update_progress(download, progress, progress_message, "Download")
+            file_path = await download
+            elapsed_time = time.time() - start_time
 
-            with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                zip_ref.extractall(extracted_path)
+            # Use the size the download reported, falling back to stat if the server sent no Content-Length
+            file_size = progress["total"] or await asyncio.to_thread(os.path.getsize, file_path)
+            if file_size > SPLIT_THRESHOLD:
+                # Large archives are sent as-is rather than extracted
+                await split_and_upload(file_path, message.chat.id, client, progress_message, file_size)
+                await asyncio.to_thread(os.remove, file_path)
+            elif await asyncio.to_thread(is_zip, file_path):
+                extracted_path = os.path.join(dest_path, "extracted")
+                os.makedirs(extracted_path, exist_ok=True)
 
-            os.remove(file_path)
+                if await asyncio.to_thread(should_bundle, file_path):
+                    await progress_message.edit_text("Bundling and uploading files...")
+                    produce = functools.partial(bundle_zip, file_path, extracted_path)
+                    caption = "Bundled files"
+                else:
+                    await progress_message.edit_text("Extracting and uploading files...")
+                    produce = functools.partial(extract_zip, file_path, extracted_path)
+                    caption = "Extracted file"
+                await upload_while_producing(produce, message.chat.id, client, progress_message, caption)
 
-            await progress_message.edit_text("Uploading extracted files...")
-            for root, _, files in os.walk(extracted_path):
-                for file in files:
-                    file_to_send = os.path.join(root, file)
+                await asyncio.to_thread(os.remove, file_path)
+                await asyncio.to_thread(shutil.rmtree, extracted_path, ignore_errors=True)
+            else:
+                await progress_message.edit_text("Uploading file...")
+                with open(file_path, 'rb', buffering=1024 * 1024) as fp:
                     await client.send_document(
                         chat_id=message.chat.id,
-                        document=file_to_send,
-                        caption=f"Extracted file: {file}"
+                        document=fp,
+                        file_name=os.path.basename(file_path),
+                        caption="❤️ Created by @NT_BOT_CHANNEL"
                     )
-                    os.remove(file_to_send)
+                await asyncio.to_thread(os.remove, file_path)
 
-            os.rmdir(extracted_path)
-        else:
-            if os.path.getsize(file_path) > 2 * 1024 * 1024 * 1024:
-                await split_and_upload(file_path, message.chat.id, client, progress_message)
-            else:
-                await progress_message.edit_text("Uploading file...")
-                await client.send_document(
-                    chat_id=message.chat.id,
-                    document=file_path,
-                    caption="❤️ Created by @NT_BOT_CHANNEL"
-                )
-                os.remove(file_path)
-
-        await progress_message.edit_text(f"Task completed in {elapsed_time:.2f} seconds.")
-    except Exception as e:
-        logger.error(f"An error occurred: {e}")
-        await progress_message.edit_text(f"❌ An error occurred while processing your link: {e}")
+            await progress_message.edit_text(f"Task completed in {elapsed_time:.2f} seconds.")
+        except Exception as e:
+            logger.error(f"An error occurred: {e}")
+            await progress_message.edit_text(f"❌ An error occurred while processing your link: {e}")
+        finally:
+            await asyncio.to_thread(shutil.rmtree, dest_path, ignore_errors=True)
 
 if __name__ == "__main__":
     app.run()